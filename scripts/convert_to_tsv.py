@@ -1,14 +1,20 @@
 from __future__ import print_function
 import os
 import sys
-import numpy as np
 import argparse
 import json
+import mmap
 import re
 import tarfile
 import textwrap
+from collections import defaultdict
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from zipfile import ZipFile
-from xml.etree import ElementTree
+try:
+    from lxml.etree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 if sys.version_info >= (3, 0):
     from os import makedirs
@@ -24,6 +30,17 @@ else:
             if not exist_ok:
                 raise
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:
+    orjson = None
+
+    def _json_dumps(obj):
+        """Compact json as utf-8 bytes (same output as orjson.dumps)
+        """
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
 abs_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(abs_path)
 
@@ -40,147 +57,294 @@ except (ImportError, LookupError):
     Synsetizer = None
     _syn_cache = None
 
-_valid_extensions = [".jpg", ".png"]
-_valid_phases = ["train", "test", "val"]
+_valid_extensions = frozenset([".jpg", ".png"])
+_valid_phases = ("train", "test", "val")
+_tar_extensions = frozenset(['.tar', '.tar.gz'])
+_archive_extensions = _tar_extensions | frozenset(['.zip'])
 _synset_label_pattern = re.compile(r'^(?P<LABEL>n\d{8})(?P<EXT>_\d+)?(_(?P<META>\w+))?')
 _coco_label_pattern = re.compile(r'^(?P<META>COCO_.*)?(?P<LABEL>\d{12})$')
+_json_extension_pattern = re.compile(r'\.json', re.IGNORECASE)
+_xml_extension_pattern = re.compile(r'\.xml', re.IGNORECASE)
+_extension_pattern_cache = {}
+_io_bufsize = 1 << 20  # buffer archive and tsv I/O in large chunks
+_extract_workers = min(32, (os.cpu_count() or 1) * 4)
+
+
+def _compile_extension_pattern(pattern):
+    """Compile (and cache) a case-insensitive file extension pattern
+    :param pattern: regular expression pattern string, or an already compiled pattern
+    """
+    if hasattr(pattern, 'match'):
+        return pattern
+    compiled = _extension_pattern_cache.get(pattern)
+    if compiled is None:
+        compiled = _extension_pattern_cache[pattern] = re.compile(pattern, re.IGNORECASE)
+    return compiled
+
+
+def is_within_directory(directory, target):
+    """If target path is inside the directory
+    """
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+
+    try:
+        return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+    except ValueError:
+        # paths on different drives
+        return False
+
+
+def _zip_member_name(filename):
+    """Sanitize a zip member name the way ZipFile.extract does
+    Drive letters, absolute paths and '.'/'..' components are dropped rather than rejected
+    """
+    arcname = filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid_path_parts)
+    if os.path.sep == '\\':
+        # filter illegal characters on Windows
+        arcname = ZipFile._sanitize_windows_name(arcname, os.path.sep)
+    return arcname
+
+
+def _member_target(path, name, made_dirs, is_dir=False):
+    """Find (and validate) the extraction target of an archive member, creating its directory
+    :param path: the path archive is extracted to
+    :param name: name of the member in the archive
+    :param made_dirs: set of directories already created
+    :param is_dir: if the member itself is a directory
+    """
+    target = os.path.normpath(os.path.join(path, name))
+    if not is_within_directory(path, target):
+        raise Exception("Attempted Path Traversal in Archive")
+    parent = target if is_dir else os.path.dirname(target)
+    if parent not in made_dirs:
+        makedirs(parent, exist_ok=True)
+        made_dirs.add(parent)
+    return target
+
+
+def _wait_pending(pending, limit=0):
+    """Wait until at most limit of the pending writes are left, raising any of their errors
+    :param pending: dictionary of futures keyed by the path they write to
+    """
+    while len(pending) > limit:
+        done, _ = wait(list(pending.values()), return_when=FIRST_COMPLETED)
+        for target in [target for target, future in pending.items() if future in done]:
+            pending.pop(target).result()
+
+
+def _write_file(target, data):
+    """Write data to the target file
+    """
+    with open(target, 'wb') as f:
+        f.write(data)
+
+
+def _copy_zip_member(archive, info, target):
+    """Copy a zip archive member to the target file
+    """
+    with archive.open(info) as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, _io_bufsize)
+
+
+def safe_extract(tar, path):
+    """Extract a tar archive in a single pass, with small member files written concurrently
+    Members are read serially (tar may be a stream), only the writes go to the thread pool
+    """
+    made_dirs = set()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=_extract_workers) as pool:
+        for member in tar:
+            if member.isdir():
+                _member_target(path, member.name, made_dirs, is_dir=True)
+                continue
+            target = _member_target(path, member.name, made_dirs)
+            if target in pending:
+                # a later member with the same name must overwrite the earlier one
+                pending.pop(target).result()
+            if not member.isfile():
+                # links may refer to the members being written
+                _wait_pending(pending)
+                tar.extract(member, path, set_attrs=False)
+            elif member.size > _io_bufsize:
+                # copy large members here rather than holding them in memory
+                with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, _io_bufsize)
+            else:
+                with tar.extractfile(member) as src:
+                    data = src.read()
+                pending[target] = pool.submit(_write_file, target, data)
+                # at most this many members (of at most _io_bufsize each) are held in memory
+                _wait_pending(pending, limit=4 * _extract_workers)
+        _wait_pending(pending)
+
+
+def safe_extract_zip(archive, path):
+    """Extract a zip archive, with member files decompressed and written concurrently
+    """
+    made_dirs = set()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=_extract_workers) as pool:
+        for info in archive.infolist():
+            name = _zip_member_name(info.filename)
+            if not name:
+                continue
+            if info.is_dir():
+                _member_target(path, name, made_dirs, is_dir=True)
+                continue
+            target = _member_target(path, name, made_dirs)
+            if target in pending:
+                # a later member with the same name must overwrite the earlier one
+                pending.pop(target).result()
+            pending[target] = pool.submit(_copy_zip_member, archive, info, target)
+        _wait_pending(pending)
+
+
+def _scan_archive_dir(path, extension_pattern, filter_func, is_nested):
+    """Recurse a directory for listarchive, using the cached DirEntry type to avoid extra stat calls
+    """
+    with os.scandir(path) as it:
+        # Ignore hidden files and directories
+        entries = [entry for entry in it if not entry.name.startswith(".") and not entry.name.startswith("$")]
+    new_filter_func = filter_func
+    if filter_func:
+        filtered = [entry for entry in entries if filter_func(entry.name)]
+        if filtered:
+            entries = filtered
+            new_filter_func = None  # once matched, recurse all the way
+        elif len(entries) > 1:
+            # ignore non-matching paths with more than one item
+            entries = []
+    for entry in entries:
+        if entry.is_dir():
+            sub_paths = _scan_archive_dir(entry.path, extension_pattern, new_filter_func, is_nested)
+        else:
+            sub_paths = _list_archive_file(entry.path, extension_pattern, new_filter_func, is_nested)
+        for sub_path in sub_paths:
+            yield sub_path
 
 
-def listarchive(path, is_root=True, extension_pattern='\.\w+', filter_func=None):
+def listarchive(path, is_nested=False, extension_pattern=r'\.\w+', filter_func=None):
     """Similar to listdir but (in addition to directories) extract archives locally and recurse them
     :param path: the path to start the recursion
-    :param is_root: if path is the first in recursion
-    :param extension_pattern: regular expression pattern for file extensions
+    :param is_nested: if path was itself extracted from an archive (set when recursing)
+    :param extension_pattern: regular expression pattern (or compiled pattern) for file extensions
     :param filter_func: a filter to apply on directories and files, to limit the recursion search
     """
+    extension_pattern = _compile_extension_pattern(extension_pattern)
     if os.path.isdir(path):
-        # Ignore hidden files and directories
-        sub_paths = [s0 for s0 in os.listdir(path) if not s0.startswith(".") and not s0.startswith("$")]
-        new_filter_func = filter_func
-        if filter_func:
-            filtered = [s0 for s0 in sub_paths if filter_func(s0)]
-            if filtered:
-                sub_paths = filtered
-                new_filter_func = None  # once matched, recurse all the way
-            elif len(sub_paths) > 1:
-                # ignore non-matching paths with more than one item
-                sub_paths = []
-        for s0 in sub_paths:
-            s0 = os.path.join(path, s0)
-            for sub_path in listarchive(s0, is_root=False,
-                                        extension_pattern=extension_pattern,
-                                        filter_func=new_filter_func):
-                yield sub_path
-        return
+        sub_paths = _scan_archive_dir(path, extension_pattern, filter_func, is_nested)
+    else:
+        sub_paths = _list_archive_file(path, extension_pattern, filter_func, is_nested)
+    for sub_path in sub_paths:
+        yield sub_path
 
+
+def _list_archive_file(path, extension_pattern, filter_func, is_nested):
+    """Yield a file for listarchive if its extension matches, or extract it if an archive and recurse
+    """
     local_path, fname = os.path.split(path)
-    basename, ext = os.path.splitext(fname)
-    ext = ext.lower()
-    shortname = basename
-    while '.' in shortname:
-        shortname, shortext = os.path.splitext(shortname)
-        ext = shortext + ext
-
-    if ext not in ['.tar', '.tar.gz', '.zip']:
-        if re.match(extension_pattern, ext, flags=re.IGNORECASE):
+    # the extension is everything after the first dot (e.g. .tar.gz), basename drops only the last one
+    dot = fname.find('.', 1)
+    ext = fname[dot:].lower() if dot > 0 else ''
+    basename = fname[:fname.rfind('.')] if ext else fname
+
+    if ext not in _archive_extensions:
+        if extension_pattern.match(ext):
             yield path
         return
 
     extracted_path = os.path.join(local_path, 'extracted_' + basename)
-    if os.path.exists(extracted_path):
-        for sub_path in listarchive(extracted_path, is_root=False,
-                                    extension_pattern=extension_pattern,
-                                    filter_func=filter_func):
-            yield sub_path
-        return
-
-    # extract if not yet extracted
-    makedirs(extracted_path, exist_ok=True)
-    if ext in ['.tar', '.tar.gz']:
-        with tarfile.open(path) as archive:
-            def is_within_directory(directory, target):
-            	
-            	abs_directory = os.path.abspath(directory)
-            	abs_target = os.path.abspath(target)
-            
-            	prefix = os.path.commonprefix([abs_directory, abs_target])
-            	
-            	return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-            	for member in tar.getmembers():
-            		member_path = os.path.join(path, member.name)
-            		if not is_within_directory(path, member_path):
-            			raise Exception("Attempted Path Traversal in Tar File")
-            
-            	tar.extractall(path, members, numeric_owner=numeric_owner) 
-            	
-            
-            safe_extract(archive, extracted_path)
-    elif ext in ['.zip']:
-        with ZipFile(path) as archive:
-            archive.extractall(extracted_path)
-
-    # recurse through the just-extracted path
-    for sub_path in listarchive(extracted_path, is_root=False,
-                                extension_pattern=extension_pattern,
-                                filter_func=filter_func):
+    if not os.path.exists(extracted_path):
+        # extract if not yet extracted
+        makedirs(extracted_path, exist_ok=True)
+        if ext in _tar_extensions:
+            with open(path, 'rb', buffering=_io_bufsize) as raw, \
+                    tarfile.open(fileobj=raw, mode='r|*') as archive:
+                safe_extract(archive, extracted_path)
+        elif ext == '.zip':
+            with ZipFile(path) as archive:
+                safe_extract_zip(archive, extracted_path)
+
+        # remove intermediate archives (extracted from another archive) as soon as they are extracted,
+        # even if the caller stops iterating before the recursion below is done; never the user's own files
+        if is_nested:
+            os.remove(path)
+
+    for sub_path in _scan_archive_dir(extracted_path, extension_pattern, filter_func, True):
         yield sub_path
 
-    # remove intermediate *extracted* archives
-    if not is_root:
-        os.remove(path)
 
-
-def guess_phase(path):
-    """Guess the phase from path
-    :param path: file or directory path to guess the phase name from
-    :rtype: str
+def _is_phase(elem):
+    """If a single path element names a phase
     """
-    for elem in reversed(path.replace("\\", "/").split("/")):
-        if not elem:
-            continue
-        elem_lower = elem.lower()
-        for name in _valid_phases:
-            if name in elem_lower:
-                return elem
-    return ""
+    elem_lower = elem.lower()
+    for name in _valid_phases:
+        if name in elem_lower:
+            return True
+    return False
 
 
-def guess_label(path):
-    """Guess the label from path
-    :param path: file path to guess the label from
-    :rtype: (Union[str,int], str, str)
+def _synset_label(elem):
+    """Get the synset label from a single path element, if it has one
+    :rtype: (str, str, str)
     """
+    match = _synset_label_pattern.match(elem)
+    if match:
+        label = match.group('LABEL')
+        full_label = label + (match.group('EXT') or '')
+        return label, full_label, 'IN_' + (match.group('META') or '')
 
+
+def _guess_dir(path):
+    """Guess the phase and the synset label of a directory, splitting the path only once
+    :rtype: (str, (str, str, str))
+    """
+    phase = ""
+    label = None
     for elem in reversed(path.replace("\\", "/").split("/")):
         if not elem:
             continue
-        match = _synset_label_pattern.match(elem)
-        if match:
-            label = match.group('LABEL')
-            full_label = label + match.group('EXT') or ''
-            return label, full_label, 'IN_' + (match.group('META') or '')
+        if not phase and _is_phase(elem):
+            phase = elem
+        if not label:
+            label = _synset_label(elem)
+        if phase and label:
+            break
+    return phase, label
+
+
+def _guess_label(parent, fname, elem, dir_label):
+    """Guess the label of the file fname in the directory parent
+    :param elem: fname without its extension
+    :param dir_label: synset label of the parent directory (from _guess_dir)
+    """
+    label = _synset_label(fname) or dir_label
+    if label:
+        return label
 
-    elem, _ = os.path.splitext(os.path.basename(path))
     match = _coco_label_pattern.match(elem)
     if match:
         full_label = label = match.group('LABEL')
         return int(label), full_label, 'COCO_' + (match.group('META') or '')
 
     # Use immediate directory as label
-    parent = os.path.dirname(path)
-    label = _syn_cache.synset_offset(os.path.basename(parent), os.path.basename(elem))
+    label = _syn_cache.synset_offset(os.path.basename(parent), elem)
     return label, label, label
 
 
-def gather_images(root_path, imagedata, counts, max_keep_per_label=np.inf):
+def gather_images(root_path, imagedata, counts, max_keep_per_label=float('inf'), rel_dir=''):
     """Create image information structure from images in root_path
     :param root_path: the root directory to start gathering image information
-    :param imagedata: a dictionary that will be filled with images location and labels
+    :param imagedata: a dictionary that will be filled with images location, labels and relative path
     :param counts: a dictionary that counts per-label count of images
     :param max_keep_per_label: maximum number of images to keep per-label
+    :param rel_dir: '/' separated path of root_path relative to the dataset root (set when recursing)
     
     Example:
     /root_path/training/n04422727/blue_cheese.jpg
@@ -190,132 +354,238 @@ def gather_images(root_path, imagedata, counts, max_keep_per_label=np.inf):
     /root_path/training/n04422727_42_bluecheese.jpg
     /root_path/training/COCO_val2014_000000006818.jpg
     """
-    for s0 in os.listdir(root_path):
-        if s0.startswith(".") or s0.startswith("$"):
-            # Ignore hidden files and directories
-            continue
-        s0 = os.path.join(root_path, s0)
-        phase = guess_phase(s0)
-        if os.path.isdir(s0):
-            gather_images(s0, imagedata, counts, max_keep_per_label=max_keep_per_label)
-            continue
-        _, file_extension = os.path.splitext(s0)
-        if file_extension.lower() not in _valid_extensions:
-            continue
+    # files in root_path only differ by their name
+    dir_phase, dir_label = _guess_dir(root_path)
+    with os.scandir(root_path) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith(".") or name.startswith("$"):
+                # Ignore hidden files and directories
+                continue
+            s0 = entry.path
+            relpath = rel_dir + name
+            if entry.is_dir():
+                gather_images(s0, imagedata, counts, max_keep_per_label=max_keep_per_label,
+                              rel_dir=relpath + '/')
+                continue
+            dot = name.rfind('.')
+            if dot < 0 or name[dot:].lower() not in _valid_extensions or not entry.is_file():
+                continue
+
+            phase = name if _is_phase(name) else dir_phase
+            label, full_label, meta = _guess_label(root_path, name, name[:dot], dir_label)
+
+            count = counts.get(label, 0)
+            if count and count >= max_keep_per_label:
+                # the first image of a label is always kept
+                continue
+            counts[label] = count + 1
 
-        label, full_label, meta = guess_label(s0)
+            if not phase:
+                # every phase already in imagedata is a valid phase name, reuse the latest one
+                phase = next(reversed(imagedata), "training")
+                print("Phase {} was assumed when processing {}".format(phase, s0))
 
-        if label not in counts:
-            counts[label] = 1
-        elif counts[label] >= max_keep_per_label:
-            continue
-        else:
-            counts[label] += 1
+            if phase not in imagedata:
+                imagedata[phase] = [(s0, label, full_label, meta, relpath)]
+            else:
+                imagedata[phase].append((s0, label, full_label, meta, relpath))
 
-        if not phase:
-            for phase in imagedata.keys():
-                for name in _valid_phases:
-                    if name in phase.lower():
-                        break
-            if not phase:
-                phase = "training"
-            print("Phase {} was assumed when processing {}".format(phase, s0))
 
-        if phase not in imagedata:
-            imagedata[phase] = [(s0, label, full_label, meta)]
-        else:
-            imagedata[phase].append((s0, label, full_label, meta))
+def _xml_object_rects(obj, label, path):
+    """Get the rects of a single VOC-style XML object element
+    """
+    name = obj.find('name').text
+    if name != label:
+        print('Ignore label "{}" != {} in {}'.format(name, label, path))
+        return []
+    diff = int(obj.find('difficult').text)
+    if diff:
+        print('Ignore difficult label "{}" in {}'.format(label, path))
+        return []
+    # bndbox does not seem to be 1-based, because there are some that start at 0
+    return [[int(bndbox.find(k).text) for k in ('xmin', 'ymin', 'xmax', 'ymax')]
+            for bndbox in obj.findall('bndbox')]
 
 
 def get_xml_rects(path, label):
     """Get annotation from VOC-style XML
+    Objects are parsed incrementally and cleared once used, instead of building the whole tree
     """
     rects = []
-    tree = ElementTree.parse(path)
-    for obj in tree.findall('object'):
-        name = obj.find('name').text
-        if name != label:
-            print('Ignore label "{}" != {} in {}'.format(name, label, path))
-            continue
-        diff = int(obj.find('difficult').text)
-        if diff:
-            print('Ignore difficult label "{}" in {}'.format(label, path))
-            continue
-        for bndbox in obj.findall('bndbox'):
-            # bndbox does not seem to be 1-based, because there are some that start at 0
-            rect = [int(bndbox.find(k).text) for k in ['xmin', 'ymin', 'xmax', 'ymax']]
-            rects.append(rect)
+    for _, elem in iterparse(path, events=('end',)):
+        if elem.tag == 'object':
+            rects.extend(_xml_object_rects(elem, label, path))
+            elem.clear()
 
     return rects
 
 
+def get_xml_index(ann_path, label):
+    """Find the VOC-style XML annotations of a label
+    :param ann_path: annotation archive file, or directory
+    :rtype: dict
+    :return: XML file path keyed by its name without extension
+    """
+    def voc_ann_filter(elem):
+        if label in elem:
+            return True
+
+    index = {}
+    for path in listarchive(ann_path, extension_pattern=_xml_extension_pattern, filter_func=voc_ann_filter):
+        fname, _ = os.path.splitext(os.path.basename(path))
+        index.setdefault(fname, path)
+    return index
+
+
+def load_json(path):
+    """Parse a json file
+    With orjson the file is parsed straight from a read-only memory map, without reading a copy into memory
+    """
+    with open(path, 'rb') as f:
+        if orjson is None:
+            return json.loads(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+
 def get_coco_bboxes(path):
     """Parse bboxes from json in the path
     """
-    with open(path) as f:
-        content = json.load(f)
+    content = load_json(path)
 
     annotations = content['annotations']
-    categories = {cat['id']: (cat['name'], cat['supercategory']) for cat in content['categories']}
+    # there are only a few categories, find their labels once rather than per annotation
+    labels = {cat['id']: _syn_cache.synset_offset(cat['name'], cat['supercategory'])
+              for cat in content['categories']}
     del content
 
-    bboxes = {}
+    bboxes = defaultdict(list)
     for ann in annotations:
         image_id = int(ann['image_id'])
-        cat_id = int(ann['category_id'])
-        name, parent = categories[cat_id]
-        label = _syn_cache.synset_offset(name, parent)
-        bbox = ann['bbox']
-        bbox[2] += bbox[0] - 1
-        bbox[3] += bbox[1] - 1
-        if image_id not in bboxes:
-            bboxes[image_id] = [{'class': label, 'rect': bbox}]
-        else:
-            bboxes[image_id].append({'class': label, 'rect': bbox})
+        label = labels[int(ann['category_id'])]
+        x, y, w, h = ann['bbox']
+        bboxes[image_id].append({'class': label, 'rect': [x, y, w + (x - 1), h + (y - 1)]})
+
+    bboxes.default_factory = None  # do not add images on lookup
+    return bboxes
 
+
+def _coco_phase_bboxes(phase, annotations, ann_cache):
+    """Get the parsed bboxes of the COCO instances file of a phase
+    :rtype: dict
+    :return: bboxes keyed by image id, or None if there is no instances file for the phase
+    """
+    key = ('coco', phase)
+    if key in ann_cache:
+        return ann_cache[key]
+
+    if not _syn_cache:
+        raise Exception("""Wordnet not found.
+        Install nltk and wordnet:
+        pip install nltk
+        nltk.download()  # 1. download wordnet from corpus
+                         # 2. download brown from corpus
+                         # 3. download averaged perceptron model
+        """)
+
+    bboxes = None
+    for ann_path in annotations:
+        for path in listarchive(ann_path, extension_pattern=_json_extension_pattern):
+            fname = os.path.basename(path)
+            if 'instances' in fname and phase in fname:
+                path_key = os.path.abspath(path)
+                if path_key not in ann_cache:
+                    ann_cache[path_key] = get_coco_bboxes(path)
+                bboxes = ann_cache[path_key]
+                break
+        if bboxes is not None:
+            break
+    ann_cache[key] = bboxes
     return bboxes
 
 
-def get_boxes(phase, full_label, label, meta, annotations, phase_cache):
+def _label_xml_index(ann_path, label, ann_cache):
+    """Get the (cached) XML annotation index of a label
+    """
+    key = ('xml_index', ann_path, label)
+    if key not in ann_cache:
+        ann_cache[key] = get_xml_index(ann_path, label)
+    return ann_cache[key]
+
+
+def get_boxes(phase, full_label, label, meta, annotations, ann_cache):
     """Get the list of boxes for a label
+    :param ann_cache: dictionary of parsed annotation files, shared by all the phases
     :rtype list
     """
 
     if meta.startswith('COCO_'):
-        if not _syn_cache:
-            raise Exception("""Wordnet not found.
-            Install nltk and wordnet:
-            pip install nltk
-            nltk.download()  # 1. download wordnet from corpus
-                             # 2. download brown from corpus
-                             # 3. download averaged perceptron model
-            """)
-
-        for ann_path in annotations:
-            for path in listarchive(ann_path, extension_pattern='\.json'):
-                fname = os.path.basename(path)
-                if 'instances' in fname and phase in fname:
-                    if fname not in phase_cache:
-                        phase_cache[fname] = get_coco_bboxes(path)
-                    if label not in phase_cache[fname]:
-                        # COCO needs category id from the annotation file
-                        return []
-                    return phase_cache[fname][label]
-
-    def voc_ann_filter(elem):
-        if label in elem:
-            return True
+        bboxes = _coco_phase_bboxes(phase, annotations, ann_cache)
+        if bboxes is not None:
+            # COCO needs category id from the annotation file
+            return bboxes.get(label, [])
 
     for ann_path in annotations:
-        for path in listarchive(ann_path, extension_pattern='\.xml', filter_func=voc_ann_filter):
-            fname = os.path.basename(path)
-            if fname.startswith(full_label):
-                return [{'class': label, 'rect': rect} for rect in get_xml_rects(path, label)]
+        path = _label_xml_index(ann_path, label, ann_cache).get(full_label)
+        if path:
+            return [{'class': label, 'rect': rect} for rect in get_xml_rects(path, label)]
 
     boxes = [{'class': label, 'rect': [0, 0, 0, 0]}]  # full image as a box
     return boxes
 
 
+def fill_ann_cache(phase, vs, annotations, ann_cache):
+    """Parse (and extract) all the annotations get_boxes needs for the images of a phase
+    :param vs: list of image information of the phase (from gather_images)
+    :param ann_cache: dictionary of parsed annotation files, shared by all the phases
+    :rtype: dict
+    :return: the entries of ann_cache get_boxes will look up for this phase
+    """
+    phase_cache = {}
+    for _, label, full_label, meta, _ in vs:
+        if meta.startswith('COCO_'):
+            bboxes = phase_cache[('coco', phase)] = _coco_phase_bboxes(phase, annotations, ann_cache)
+            if bboxes is not None:
+                continue
+        for ann_path in annotations:
+            index = phase_cache[('xml_index', ann_path, label)] = _label_xml_index(ann_path, label, ann_cache)
+            if full_label in index:
+                break
+    return phase_cache
+
+
+def tsv_row(full_label, boxes, relpath):
+    """Encode a single row of the tsv file
+    :rtype: bytes
+    """
+    return b"\t".join((full_label.encode('utf-8'), _json_dumps(boxes), relpath.encode('utf-8'))) + b"\n"
+
+
+def write_phase_tsv(phase, vs, root_path, annotations, ann_cache=None):
+    """Write the tsv and lineidx files of a phase
+    :param vs: list of image information of the phase (from gather_images)
+    :param ann_cache: dictionary of parsed annotation files, to share with other calls
+    """
+    if ann_cache is None:
+        ann_cache = {}
+    # keep track of the tsv position, tell() would flush the buffer on every row
+    pos = 0
+    with open(os.path.join(root_path, phase + '.lineidx'), "wb", buffering=_io_bufsize) as idx_file:
+        with open(os.path.join(root_path, phase + '.tsv'), "wb", buffering=_io_bufsize) as tsv_file:
+            idx_write = idx_file.write
+            tsv_write = tsv_file.write
+            for path, label, full_label, meta, relpath in vs:
+                boxes = get_boxes(phase, full_label, label, meta, annotations, ann_cache)
+                if not boxes:
+                    print("No annotation for {}".format(path))
+                    continue
+                line = tsv_row(full_label, boxes, relpath)
+                idx_write(b"%d\n" % pos)
+                tsv_write(line)
+                pos += len(line)
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -327,7 +597,7 @@ convert_to_tsv.py d:/data/fridge -a d:/data/coco/annotations_fridge/
 '''))
 
     parser.add_argument('-k', '--keep', help='Maximum number of images to keep for each label',
-                        type=float, default=np.inf)
+                        type=float, default=float('inf'))
     parser.add_argument('-a', '--annotation', action='append', required=True, default=[],
                         help='Annotation archive file, or directory (can be specified multiple times)')
     parser.add_argument('root_path', metavar='PATH', help='path to the images dataset')
@@ -346,21 +616,22 @@ convert_to_tsv.py d:/data/fridge -a d:/data/coco/annotations_fridge/
 
     # noinspection PyTypeChecker
     multi_phase = len(images.keys()) > 1
-    for phase, vs in images.items():
-        if multi_phase:
+    if not multi_phase:
+        for phase, vs in images.items():
+            write_phase_tsv(phase, vs, root_path, args.annotation)
+        return images, counts
+
+    # phases write to their own files and can run in parallel, but annotation archives are extracted on demand,
+    # so find and parse what each phase needs here; the workers then only look it up
+    ann_cache = {}
+    with ProcessPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as pool:
+        futures = []
+        for phase, vs in images.items():
             print("Phase: {}".format(phase))
-        phase_cache = {}
-        with open(os.path.join(root_path, phase + '.lineidx'), "w") as idx_file:
-            with open(os.path.join(root_path, phase + '.tsv'), "w") as tsv_file:
-                for v in vs:
-                    path, label, full_label, meta = v
-                    relpath = os.path.relpath(path, root_path).replace("\\", "/")
-                    boxes = get_boxes(phase, full_label, label, meta, args.annotation, phase_cache)
-                    if not boxes:
-                        print("No annotation for {}".format(path))
-                        continue
-                    idx_file.write("{}\n".format(tsv_file.tell()))
-                    tsv_file.write("{}\t{}\t{}\n".format(full_label, json.dumps(boxes), relpath))
+            phase_cache = fill_ann_cache(phase, vs, args.annotation, ann_cache)
+            futures.append(pool.submit(write_phase_tsv, phase, vs, root_path, args.annotation, phase_cache))
+        for future in futures:
+            future.result()
 
     return images, counts
 